@@ -24,6 +24,7 @@ use Illuminate\Bus\Queueable;
 use Illuminate\Contracts\Queue\ShouldQueue;
 use Illuminate\Queue\InteractsWithQueue;
 use Illuminate\Queue\SerializesModels;
+use Log;
 use SplFileObject;
 use Throwable;
 
@@ -43,12 +44,30 @@ class PtpJob extends BaseJob implements ShouldQueue
      */
     protected string $tmpImageInputFile;
 
+    /**
+     * File where the per-label area priors for the Python script will be kept
+     * @var string
+     */
+    protected string $tmpAreaPriorsFile;
+
     /**
      * File where result data from the Python conversion script will be stored
      * @var string
      */
     protected string $outputFile;
 
+    /**
+     * File where the statistics of the Python conversion script will be stored
+     * @var string
+     */
+    protected string $statsFile;
+
+    /**
+     * Format of the file with result data from the Python conversion script
+     * @var string
+     */
+    protected string $outputFormat = 'csv';
+
     /**
      * Number of images to be processed per chunk
      * @var int
@@ -61,6 +80,13 @@ class PtpJob extends BaseJob implements ShouldQueue
      */
     public static int $insertChunkSize = 5000;
 
+    /**
+     * Number of point annotations that were not converted, e.g. because the fallback
+     * budget of the conversion was exhausted
+     * @var int
+     */
+    protected int $skippedAnnotations = 0;
+
     /**
      * Ignore this job if the project or volume does not exist any more.
      *
@@ -95,11 +121,15 @@ class PtpJob extends BaseJob implements ShouldQueue
         //$inputFile.'.json' will be used for image annotations, $inputFile.'_images.json' for image paths
         $inputFile = 'ptp/input-files/'.$volume->id;
 
-        $outputFile = 'ptp/'.$volume->id.'_converted_annotations.csv';
+        $this->outputFormat = config('ptp.output_format');
+        $extension = $this->outputFormat === 'binary' ? 'bin' : 'csv';
+        $outputFile = 'ptp/'.$volume->id.'_converted_annotations.'.$extension;
 
         $this->outputFile = config('ptp.temp_dir').'/'.$outputFile;
+        $this->statsFile = config('ptp.temp_dir').'/ptp/'.$volume->id.'_conversion_stats.json';
         $this->tmpInputFile = config('ptp.temp_dir').'/'.$inputFile.'.json';
         $this->tmpImageInputFile = config('ptp.temp_dir').'/'.$inputFile.'_images.json';
+        $this->tmpAreaPriorsFile = config('ptp.temp_dir').'/'.$inputFile.'_area_priors.json';
     }
 
     /**
@@ -110,6 +140,10 @@ class PtpJob extends BaseJob implements ShouldQueue
     public function handle()
     {
         DB::transaction(function () {
+            if (config('ptp.area_priors')) {
+                $this->generateAreaPriorsFile();
+            }
+
             $callback = function ($images, $paths) {
                 $this->generateImageInputFile($paths, $images);
                 $this->python();
@@ -124,7 +158,10 @@ class PtpJob extends BaseJob implements ShouldQueue
                 }
             });
         });
-        $this->user->notify(new PtpJobConcluded($this->volume));
+        if ($this->skippedAnnotations > 0) {
+            Log::warning("PTP job for volume {$this->volume->id} skipped {$this->skippedAnnotations} point annotations that could not be converted.");
+        }
+        $this->user->notify(new PtpJobConcluded($this->volume, $this->skippedAnnotations));
         $this->cleanupJob();
         $this->cleanupFiles();
     }
@@ -179,6 +216,71 @@ class PtpJob extends BaseJob implements ShouldQueue
         return $images;
     }
 
+    /**
+     * Generate the file containing the median area of the existing polygon annotations
+     * of each label that is attached to a point annotation of the volume.
+     */
+    public function generateAreaPriorsFile(): void
+    {
+        $pointLabelIds = ImageAnnotationLabel::join('image_annotations', 'image_annotations.id', '=', 'image_annotation_labels.annotation_id')
+            ->join('images', 'image_annotations.image_id', '=', 'images.id')
+            ->where('images.volume_id', $this->volume->id)
+            ->where('image_annotations.shape_id', Shape::pointId())
+            ->distinct()
+            ->pluck('image_annotation_labels.label_id');
+
+        $polygons = ImageAnnotation::join('image_annotation_labels', 'image_annotations.id', '=', 'image_annotation_labels.annotation_id')
+            ->join('images', 'image_annotations.image_id', '=', 'images.id')
+            ->where('images.volume_id', $this->volume->id)
+            ->where('image_annotations.shape_id', Shape::polygonId())
+            ->whereIn('image_annotation_labels.label_id', $pointLabelIds)
+            ->select('image_annotations.id as id', 'image_annotations.points as points', 'image_annotation_labels.label_id as label_id')
+            ->lazy();
+
+        $areas = [];
+        foreach ($polygons as $polygon) {
+            $areas[$polygon->label_id][] = $this->polygonArea($polygon->points);
+        }
+
+        $minSamples = config('ptp.area_prior_min_samples');
+        $priors = [];
+        foreach ($areas as $labelId => $labelAreas) {
+            if (count($labelAreas) >= $minSamples) {
+                $priors[$labelId] = collect($labelAreas)->median();
+            }
+        }
+
+        if (empty($priors)) {
+            File::delete($this->tmpAreaPriorsFile);
+            return;
+        }
+
+        if (!File::exists(dirname($this->tmpAreaPriorsFile))) {
+            File::makeDirectory(dirname($this->tmpAreaPriorsFile), 0700, true, true);
+        }
+
+        File::put($this->tmpAreaPriorsFile, json_encode($priors));
+    }
+
+    /**
+     * Compute the area of a polygon with the shoelace formula
+     *
+     * @param array $points Polygon coordinates of type [x1, y1, x2, y2...]
+     * @return float
+     */
+    protected function polygonArea(array $points): float
+    {
+        $area = 0;
+        $count = intdiv(count($points), 2);
+
+        for ($i = 0; $i < $count; $i++) {
+            $j = ($i + 1) % $count;
+            $area += $points[2 * $i] * $points[2 * $j + 1] - $points[2 * $j] * $points[2 * $i + 1];
+        }
+
+        return abs($area) / 2;
+    }
+
     /**
      * Generate the input file containing image id and path data
      *
@@ -220,7 +322,40 @@ class PtpJob extends BaseJob implements ShouldQueue
         }
 
 
-        $command = "{$python} -u {$script} --image-paths-file {$this->tmpImageInputFile} --input-file {$this->tmpInputFile} --model-type {$modelType} --model-path {$modelPath} --output-file {$this->outputFile} ";
+        $command = "{$python} -u {$script} --image-paths-file {$this->tmpImageInputFile} --input-file {$this->tmpInputFile} --model-type {$modelType} --model-path {$modelPath} --output-file {$this->outputFile} --output-format {$this->outputFormat} --stats-file {$this->statsFile} ";
+
+        // Check the config so a stale file of a failed job is never used.
+        if (config('ptp.area_priors') && File::exists($this->tmpAreaPriorsFile)) {
+            $command .= "--expected-areas-file {$this->tmpAreaPriorsFile} ";
+        }
+
+        $strategy = config('ptp.fallback_strategy');
+        $command .= "--fallback-strategy {$strategy} ";
+
+        $timeBudget = config('ptp.fallback_time_budget');
+        if (!is_null($timeBudget)) {
+            $command .= "--fallback-time-budget {$timeBudget} ";
+        }
+
+        $encoderBudget = config('ptp.fallback_encoder_budget');
+        if (!is_null($encoderBudget)) {
+            $command .= "--fallback-encoder-budget {$encoderBudget} ";
+        }
+
+        $tileMinImageSize = config('ptp.tile_min_image_size');
+        $tileSize = config('ptp.tile_size');
+        $tileOverlap = config('ptp.tile_overlap');
+        $command .= "--tile-min-image-size {$tileMinImageSize} --tile-size {$tileSize} --tile-overlap {$tileOverlap} ";
+
+        $simplifyTolerance = config('ptp.simplify_tolerance');
+        if (!is_null($simplifyTolerance)) {
+            $command .= "--simplify-tolerance {$simplifyTolerance} ";
+        }
+
+        $maxVertices = config('ptp.max_vertices');
+        if (!is_null($maxVertices)) {
+            $command .= "--max-vertices {$maxVertices} ";
+        }
 
         exec("$command 2>&1", $lines, $code);
 
@@ -228,6 +363,26 @@ class PtpJob extends BaseJob implements ShouldQueue
             $lines = implode("\n", $lines);
             throw new PythonException("Error while executing python script '{$script}':\n{$lines}", $code);
         }
+
+        $this->logStatistics();
+    }
+
+    /**
+     * Log the statistics of the last conversion, e.g. the decoder calls per successful
+     * conversion of the fallback strategies or the vertices saved by the simplification.
+     */
+    protected function logStatistics(): void
+    {
+        if (File::missing($this->statsFile)) {
+            return;
+        }
+
+        $stats = json_decode(File::get($this->statsFile), true);
+        File::delete($this->statsFile);
+
+        if (is_array($stats)) {
+            Log::info("PTP conversion statistics for volume {$this->volume->id}", $stats);
+        }
     }
 
     /**
@@ -240,9 +395,15 @@ class PtpJob extends BaseJob implements ShouldQueue
             return;
         }
 
+        if ($this->outputFormat === 'binary') {
+            $iterator = $this->iterateOverBinaryFile($this->outputFile);
+        } else {
+            $iterator = $this->iterateOverCsvFile($this->outputFile);
+        }
+
         $insertAnnotations = [];
         $insertAnnotationLabels = [];
-        foreach ($this->iterateOverCsvFile($this->outputFile) as $idx => $annotation) {
+        foreach ($iterator as $idx => $annotation) {
             $polygonShape = Shape::polygonId();
 
             $now = Carbon::now();
@@ -250,6 +411,7 @@ class PtpJob extends BaseJob implements ShouldQueue
             //It might happen that we are unable to convert some of the point
             //annotations. In this case, we should not upload the data.
             if (is_null($annotation['points'])) {
+                $this->skippedAnnotations += 1;
                 continue;
             }
 
@@ -329,7 +491,7 @@ class PtpJob extends BaseJob implements ShouldQueue
      */
     public function cleanupFiles(): void
     {
-        File::delete([$this->outputFile, $this->tmpInputFile, $this->tmpImageInputFile]);
+        File::delete([$this->outputFile, $this->tmpInputFile, $this->tmpImageInputFile, $this->tmpAreaPriorsFile, $this->statsFile]);
     }
 
     /**
@@ -415,6 +577,72 @@ class PtpJob extends BaseJob implements ShouldQueue
         }
     }
 
+    /**
+     * Create a generator that iterates the annotations of a binary file containing results from the PTP conversion.
+     * The layout of the file is documented in write_binary_output of the Python script.
+     * @param $file Binary file to open
+     * @return Generator
+     */
+    protected function iterateOverBinaryFile(
+        string $file,
+    ): Generator {
+
+        if (File::size($file) == 0) {
+            throw new Exception('No annotations were converted!');
+        }
+
+        // The index and the coordinates are read in parallel so the file never has
+        // to be loaded completely.
+        $index = fopen($file, 'rb');
+        $coordinates = fopen($file, 'rb');
+
+        try {
+            $header = fread($index, 24);
+            if ($header === false || strlen($header) !== 24) {
+                throw new Exception("Annotation file $file is malformed");
+            }
+
+            $header = unpack('a4magic/Vversion/Pcount/Pcoordinates', $header);
+            if ($header['magic'] !== 'PTPB' || $header['version'] !== 1) {
+                throw new Exception("Annotation file $file is malformed");
+            }
+
+            fseek($coordinates, 24 + 32 * $header['count']);
+
+            for ($i = 0; $i < $header['count']; $i++) {
+                $entry = fread($index, 32);
+                if ($entry === false || strlen($entry) !== 32) {
+                    throw new Exception("Annotation file $file is malformed");
+                }
+
+                $entry = unpack('Pannotation_id/Pimage_id/Plabel_id/Pcount', $entry);
+                $points = null;
+
+                if ($entry['count'] > 0) {
+                    $data = fread($coordinates, 4 * $entry['count']);
+                    if ($data === false || strlen($data) !== 4 * $entry['count']) {
+                        throw new Exception("Annotation file $file is malformed");
+                    }
+                    // There is no signed little-endian 32 bit format for unpack.
+                    $points = array_map(
+                        fn ($v) => $v >= 0x80000000 ? $v - 0x100000000 : $v,
+                        array_values(unpack('V*', $data))
+                    );
+                }
+
+                yield [
+                    'annotation_id' => $entry['annotation_id'],
+                    'points' => $points,
+                    'image_id' => $entry['image_id'],
+                    'label_id' => $entry['label_id'],
+                ];
+            }
+        } finally {
+            fclose($index);
+            fclose($coordinates);
+        }
+    }
+
     /**
      * Open A CSV file.
      * @param $file CSV file to open
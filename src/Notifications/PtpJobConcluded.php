@@ -18,17 +18,24 @@ class PtpJobConcluded extends Notification
      */
     protected int $volumeId;
 
+    /**
+     * Number of point annotations that could not be converted.
+     */
+    protected int $skippedAnnotations;
+
     /**
      * Create a new notification instance.
      *
      * @param $volume In which volume PTP was run
+     * @param $skippedAnnotations Number of point annotations that could not be converted
      *
      * @return void
      */
-    public function __construct(Volume $volume)
+    public function __construct(Volume $volume, int $skippedAnnotations = 0)
     {
         $this->volumeName = $volume->name;
         $this->volumeId = $volume->id;
+        $this->skippedAnnotations = $skippedAnnotations;
     }
 
     /**
@@ -64,6 +71,10 @@ class PtpJobConcluded extends Notification
             ->subject('Magic SAM point conversion finished')
             ->line("The Magic SAM point conversion for volume $this->volumeName has concluded successfully.");
 
+        if ($this->skippedAnnotations > 0) {
+            $message = $message->line($this->getSkippedMessage());
+        }
+
 
         if (config('app.url')) {
             $message = $message->action('Show volume', route('volume', $this->volumeId));
@@ -87,7 +98,20 @@ class PtpJobConcluded extends Notification
             'actionLink' => route('volume', $this->volumeId),
         ];
 
+        if ($this->skippedAnnotations > 0) {
+            $array['message'] .= ' '.$this->getSkippedMessage();
+        }
 
         return $array;
     }
+
+    /**
+     * Get the message about the point annotations that could not be converted.
+     *
+     * @return string
+     */
+    protected function getSkippedMessage()
+    {
+        return "{$this->skippedAnnotations} point annotations were skipped because they could not be converted in time.";
+    }
 }
@@ -52,6 +52,75 @@ return [
     */
     'model_type' => env('PTP_MODEL_TYPE', 'vit_h'),
 
+    /*
+    | Wall-clock seconds that the conversion of a chunk of images may spend on the
+    | expensive fallback strategies after all cheap stages ran. Annotations that
+    | could not be processed within the budget are skipped. Set to null for no limit.
+    */
+    'fallback_time_budget' => env('PTP_FALLBACK_TIME_BUDGET', null),
+
+    /*
+    | Number of image encoder calls that the conversion of a chunk of images may
+    | spend on the expensive fallback strategies. Set to null for no limit.
+    */
+    'fallback_encoder_budget' => env('PTP_FALLBACK_ENCODER_BUDGET', null),
+
+    /*
+    | Fallback strategy for annotations that could not be converted by the cheap
+    | stages.
+    |
+    | Available are: "cascade" (random prompt fallbacks), "refine" (iterative
+    | refinement of the previous mask)
+    */
+    'fallback_strategy' => env('PTP_FALLBACK_STRATEGY', 'cascade'),
+
+    /*
+    | Format of the file with the converted annotations that is written by the Python
+    | script.
+    |
+    | Available are: "csv", "binary" (flat coordinate buffers, see ptp.py)
+    */
+    'output_format' => env('PTP_OUTPUT_FORMAT', 'csv'),
+
+    /*
+    | Images whose long side exceeds this size in pixels are split into tiles for the
+    | estimation of the expected areas. Set to 0 to disable tiling.
+    */
+    'tile_min_image_size' => env('PTP_TILE_MIN_IMAGE_SIZE', 4096),
+
+    /*
+    | Edge length in pixels of the tiles of large images.
+    */
+    'tile_size' => env('PTP_TILE_SIZE', 1024),
+
+    /*
+    | Minimum overlap in pixels of neighbouring tiles. Must be less than the tile size.
+    */
+    'tile_overlap' => env('PTP_TILE_OVERLAP', 256),
+
+    /*
+    | Douglas-Peucker tolerance to simplify the converted polygons, relative to the
+    | polygon perimeter. Set to null to disable the simplification.
+    */
+    'simplify_tolerance' => env('PTP_SIMPLIFY_TOLERANCE', null),
+
+    /*
+    | Maximum number of vertices of a converted polygon. Set to null for no limit.
+    */
+    'max_vertices' => env('PTP_MAX_VERTICES', null),
+
+    /*
+    | Use the median area of existing polygon annotations of the volume as expected
+    | area of a label. Annotations of labels with such a prior are converted right
+    | away instead of waiting until enough expected areas were estimated.
+    */
+    'area_priors' => env('PTP_AREA_PRIORS', true),
+
+    /*
+    | Minimum number of polygon annotations of a label to compute its area prior.
+    */
+    'area_prior_min_samples' => env('PTP_AREA_PRIOR_MIN_SAMPLES', 10),
+
     'notifications' => [
         /*
         | Set the way notifications for PTP job state changes are sent by default.
@@ -0,0 +1,180 @@
+"""
+Compare the fallback strategies of ptp.py on the same input.
+
+The script takes the same input files as ptp.py. It estimates the expected areas
+with the full image pass and runs the cheap zoom stage. Every annotation that
+needs the fallbacks is then converted with each strategy, using the same random
+seed. It reports the decoder calls per successful conversion of each strategy.
+
+Example:
+    python benchmark_fallbacks.py -i images.json --input-file annotations.json \\
+        --model-type vit_h --model-path sam_checkpoint.pth --output-file stats.json
+"""
+
+import argparse
+import json
+import random
+
+import numpy as np
+from PIL import Image
+
+from ptp import (
+    FALLBACK_METHODS,
+    REFINE_METHODS,
+    CountingPredictor,
+    ExpectedAreaEstimator,
+    FallbackScheduler,
+    PointAnnotation,
+    load_sam_model,
+    process_annotation_fallbacks,
+    process_annotation_zoom,
+    process_expected_area,
+)
+
+STRATEGIES = {"cascade": FALLBACK_METHODS, "refine": REFINE_METHODS}
+
+
+def benchmark(
+    input_values: dict, image_paths: dict, sam: CountingPredictor, seed: int = 0
+) -> dict:
+    """
+    Run all fallback strategies on the annotations that fail the zoom stage
+
+    Args:
+        input_values: Mapping of image IDs to annotations, like the ptp.py input
+        image_paths: Mapping of image IDs to image paths
+        sam: SAM predictor object that counts the encoder and decoder calls
+        seed: random seed that is set before each conversion
+
+    Returns:
+        dict with the statistics of each strategy
+    """
+    estimator = ExpectedAreaEstimator()
+    annotations = {}
+
+    for image_id, image_annotations in input_values.items():
+        if len(image_annotations) == 0:
+            continue
+        image = np.array(Image.open(image_paths[image_id]))
+        sam.set_image(image)
+        annotations[image_id] = []
+        for annotation in image_annotations:
+            point_annotation = PointAnnotation(
+                annotation["points"][0],
+                annotation["points"][1],
+                annotation["label"],
+                annotation["annotation_id"],
+                image_id,
+            )
+            result = process_expected_area(point_annotation, image, sam)
+            estimator.add(result["label_id"], result["contour_area"])
+            annotations[image_id].append(point_annotation)
+
+    schedulers = {
+        name: FallbackScheduler(methods=methods) for name, methods in STRATEGIES.items()
+    }
+    stats = {name: {"annotations": 0, "encoder_calls": 0} for name in STRATEGIES}
+
+    for image_id, image_annotations in annotations.items():
+        image = np.array(Image.open(image_paths[image_id]))
+        for annotation in image_annotations:
+            expected_area = estimator.get(annotation.label)
+            if expected_area is None:
+                continue
+
+            if (
+                process_annotation_zoom(
+                    annotation, image_id, image, sam, expected_area
+                )
+                is not None
+            ):
+                continue
+
+            for name, scheduler in schedulers.items():
+                random.seed(seed)
+                np.random.seed(seed)
+                encoder_calls = sam.encoder_calls
+                process_annotation_fallbacks(
+                    annotation,
+                    image_id,
+                    image,
+                    sam,
+                    expected_area,
+                    methods=scheduler.methods,
+                    scheduler=scheduler,
+                )
+                stats[name]["annotations"] += 1
+                stats[name]["encoder_calls"] += sam.encoder_calls - encoder_calls
+
+    for name, scheduler in schedulers.items():
+        statistics = scheduler.statistics()
+        methods = statistics["methods"].values()
+        stats[name].update(
+            {
+                "successes": sum(m["successes"] for m in methods),
+                "decoder_calls": sum(m["decoder_calls"] for m in methods),
+                "decoder_calls_per_success": statistics["decoder_calls_per_success"],
+                "methods": statistics["methods"],
+            }
+        )
+
+    return stats
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        "--image-paths-file",
+        "-i",
+        type=str,
+        required=True,
+        help="Path to the image paths file of ptp.py",
+    )
+    argparser.add_argument(
+        "--input-file",
+        type=str,
+        required=True,
+        help="Input file of ptp.py containing the annotations",
+    )
+    argparser.add_argument("--model-type", type=str, help="Model type")
+    argparser.add_argument("--model-path", type=str, help="Path to model weights")
+    argparser.add_argument(
+        "--device", type=str, help="Device to run the model on", default="cuda"
+    )
+    argparser.add_argument(
+        "--seed", type=int, help="Random seed of the random prompts", default=0
+    )
+    argparser.add_argument(
+        "--output-file",
+        type=str,
+        help="Where to save the statistics as JSON",
+        default=None,
+    )
+    args = argparser.parse_args()
+
+    with open(args.input_file, "r") as inp:
+        input_values = json.load(inp)
+
+    with open(args.image_paths_file, "r") as inp:
+        image_paths = json.load(inp)
+
+    from segment_anything import SamPredictor
+
+    sam_model = load_sam_model(args.model_type, args.model_path, args.device)
+    sam = CountingPredictor(SamPredictor(sam_model))
+
+    stats = benchmark(input_values, image_paths, sam, args.seed)
+
+    for name, values in stats.items():
+        per_success = values["decoder_calls_per_success"]
+        per_success = "-" if per_success is None else f"{per_success:.2f}"
+        print(
+            f"{name}: {values['successes']} of {values['annotations']} annotations "
+            f"converted, {values['decoder_calls']} decoder calls, "
+            f"{values['encoder_calls']} encoder calls, "
+            f"{per_success} decoder calls per success"
+        )
+
+    if args.output_file is not None:
+        with open(args.output_file, "w") as out:
+            json.dump(stats, out)
@@ -1,22 +1,332 @@
+from __future__ import annotations
+
+import time
+
+# Taken before all other imports so the reported startup times include them.
+START_TIME = time.monotonic()
+
 import argparse
+import heapq
 import json
 import math
 import os
 import random
-from collections import namedtuple
-from typing import Union
+import resource
+from collections import defaultdict, namedtuple
+from typing import TYPE_CHECKING, Union
 
 import cv2
-import pandas as pd
 import numpy as np
 from PIL import Image
-from segment_anything import SamPredictor, sam_model_registry
+
+# torch, pandas and segment_anything are imported where they are first used to
+# speed up the startup of the script.
+if TYPE_CHECKING:
+    from segment_anything import SamPredictor
 
 PointAnnotation = namedtuple(
     "Annotation",
     ["x", "y", "label", "annotation_id", "image_id"],
 )
 
+# Fallback strategies of process_annotation, in the order of the default cascade
+FALLBACK_METHODS = ["superzoom", "negative", "multipoint", "inaccurate"]
+
+# Fallback strategies that refine the previous mask instead of using random prompts
+REFINE_METHODS = ["refine"]
+
+BINARY_OUTPUT_MAGIC = b"PTPB"
+BINARY_OUTPUT_VERSION = 1
+
+
+class RunningMedian:
+    """Maintain the exact median of a stream of values with two heaps."""
+
+    def __init__(self):
+        # max heap (stored negated) of the lower half, min heap of the upper half
+        self.lower = []
+        self.upper = []
+
+    def __len__(self) -> int:
+        return len(self.lower) + len(self.upper)
+
+    def add(self, value: float) -> None:
+        """
+        Add a value to the stream
+
+        Args:
+            value: new value
+        """
+        if not self.lower or value <= -self.lower[0]:
+            heapq.heappush(self.lower, -value)
+        else:
+            heapq.heappush(self.upper, value)
+
+        if len(self.lower) > len(self.upper) + 1:
+            heapq.heappush(self.upper, -heapq.heappop(self.lower))
+        elif len(self.upper) > len(self.lower):
+            heapq.heappush(self.lower, -heapq.heappop(self.upper))
+
+    def median(self) -> float | None:
+        """
+        Get the median of all values seen so far
+
+        Returns:
+            The median, None if no value was added yet
+        """
+        if not self.lower:
+            return None
+        if len(self.lower) > len(self.upper):
+            return -self.lower[0]
+        return (-self.lower[0] + self.upper[0]) / 2
+
+
+class ExpectedAreaEstimator:
+    """
+    Online estimation of the expected area of each label.
+
+    The estimate of a label is considered stable once at least min_samples areas
+    were observed. Annotations of labels that are not yet stable should be deferred
+    until all areas are known. Labels can be seeded with a prior area which is
+    stable right away and takes precedence over observed areas.
+    """
+
+    def __init__(self, min_samples: int = 20, priors: dict | None = None):
+        self.min_samples = min_samples
+        self.medians = defaultdict(RunningMedian)
+        self.priors = dict(priors) if priors is not None else {}
+
+    def has_prior(self, label_id: int) -> bool:
+        return label_id in self.priors
+
+    def add(self, label_id: int, area: float | None) -> None:
+        """
+        Add the area of a first pass contour
+
+        Args:
+            label_id: ID of the label of the annotation
+            area: contour area, ignored if None or NaN
+        """
+        if area is None or np.isnan(area):
+            return
+        self.medians[label_id].add(area)
+
+    def is_stable(self, label_id: int) -> bool:
+        """
+        Returns whether enough areas were observed to use the estimate of the label
+        """
+        return label_id in self.priors or (
+            label_id in self.medians
+            and len(self.medians[label_id]) >= self.min_samples
+        )
+
+    def get(self, label_id: int) -> float | None:
+        """
+        Get the current expected area of the label
+
+        Returns:
+            The prior area or the median of the observed areas, None if neither exists
+        """
+        if label_id in self.priors:
+            return self.priors[label_id]
+        if label_id not in self.medians:
+            return None
+        return self.medians[label_id].median()
+
+    def is_empty(self) -> bool:
+        return len(self.medians) == 0 and len(self.priors) == 0
+
+
+class CountingPredictor:
+    """Wrap a SamPredictor and count the encoder and decoder calls."""
+
+    def __init__(self, predictor: SamPredictor):
+        self.predictor = predictor
+        self.encoder_calls = 0
+        self.decoder_calls = 0
+        self.first_prediction_time = None
+
+    def set_image(self, *args, **kwargs):
+        self.encoder_calls += 1
+        return self.predictor.set_image(*args, **kwargs)
+
+    def predict(self, *args, **kwargs):
+        self.decoder_calls += 1
+        result = self.predictor.predict(*args, **kwargs)
+        if self.first_prediction_time is None:
+            self.first_prediction_time = time.monotonic()
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self.predictor, name)
+
+
+class FallbackScheduler:
+    """
+    Schedule the expensive fallback strategies of process_annotation.
+
+    If a budget is configured, annotations that fail the cheap zoom stage are
+    deferred. Once all cheap stages ran, the fallbacks are run until the wall-clock
+    or encoder call budget is exhausted. The strategies are tried in the order of
+    their observed success rate. Annotations that could not be processed within the
+    budget are reported as skipped.
+    """
+
+    def __init__(
+        self,
+        time_budget: float | None = None,
+        encoder_budget: int | None = None,
+        methods: list[str] = FALLBACK_METHODS,
+    ):
+        self.time_budget = time_budget
+        self.encoder_budget = encoder_budget
+        self.methods = methods
+        self.attempts = defaultdict(int)
+        self.successes = defaultdict(int)
+        self.decoder_calls = defaultdict(int)
+        # image_id -> list of (annotation, expected_area)
+        self.pending = defaultdict(list)
+        self.skipped = []
+
+    @property
+    def has_budget(self) -> bool:
+        return self.time_budget is not None or self.encoder_budget is not None
+
+    def defer(self, annotation: PointAnnotation, expected_area: float) -> None:
+        """
+        Queue an annotation for the fallback pass
+
+        Args:
+            annotation: Point annotation that failed the cheap stages
+            expected_area: expected area for the conversion
+        """
+        self.pending[annotation.image_id].append((annotation, expected_area))
+
+    def record(self, method: str, success: bool, decoder_calls: int = 0) -> None:
+        """
+        Record the outcome of a fallback strategy
+
+        Args:
+            method: name of the strategy
+            success: whether the strategy produced a compatible contour
+            decoder_calls: number of decoder calls of the strategy
+        """
+        self.attempts[method] += 1
+        self.decoder_calls[method] += decoder_calls
+        if success:
+            self.successes[method] += 1
+
+    def success_rate(self, method: str) -> float:
+        # Laplace smoothing so untried strategies are neither preferred nor excluded
+        return (self.successes[method] + 1) / (self.attempts[method] + 2)
+
+    def method_order(self) -> list[str]:
+        """
+        Get the fallback strategies in the order of their expected success
+
+        Returns:
+            List of strategies, ties keep the configured order
+        """
+        return sorted(self.methods, key=lambda m: -self.success_rate(m))
+
+    def run(self, image_paths: dict, sam: CountingPredictor) -> list[dict]:
+        """
+        Run the fallback pass on all deferred annotations within the budget
+
+        Args:
+            image_paths: Mapping of image IDs to image paths
+            sam: SAM predictor object that counts the encoder calls
+
+        Returns:
+            List of converted annotations
+        """
+        start_time = time.monotonic()
+        start_encoder_calls = sam.encoder_calls
+        results = []
+
+        def budget_exhausted() -> bool:
+            if (
+                self.time_budget is not None
+                and time.monotonic() - start_time >= self.time_budget
+            ):
+                return True
+            return (
+                self.encoder_budget is not None
+                and sam.encoder_calls - start_encoder_calls >= self.encoder_budget
+            )
+
+        for image_id, pending in self.pending.items():
+            image = None
+            for annotation, expected_area in pending:
+                if budget_exhausted():
+                    self.skipped.append(annotation)
+                    continue
+
+                if image is None:
+                    image = np.array(Image.open(image_paths[image_id]))
+
+                results.append(
+                    process_annotation_fallbacks(
+                        annotation,
+                        image_id,
+                        image,
+                        sam,
+                        expected_area,
+                        methods=self.method_order(),
+                        scheduler=self,
+                    )
+                )
+
+        self.pending.clear()
+        return results
+
+    def statistics(self) -> dict:
+        """
+        Get the statistics of the fallback strategies
+
+        Returns:
+            dict with the attempts, successes and decoder calls of each strategy, the
+            decoder calls per successful conversion and the number of skipped
+            annotations
+        """
+        successes = sum(self.successes.values())
+        calls = sum(self.decoder_calls.values())
+        return {
+            "methods": {
+                method: {
+                    "attempts": self.attempts[method],
+                    "successes": self.successes[method],
+                    "decoder_calls": self.decoder_calls[method],
+                }
+                for method in self.methods
+            },
+            "decoder_calls_per_success": calls / successes if successes > 0 else None,
+            "skipped": len(self.skipped),
+        }
+
+    def report(self) -> None:
+        """Print the statistics of the fallback strategies and the skipped annotations"""
+        for method in self.methods:
+            if self.attempts[method] > 0:
+                print(
+                    f"Fallback '{method}': {self.successes[method]} of "
+                    f"{self.attempts[method]} attempts successful, "
+                    f"{self.decoder_calls[method]} decoder calls"
+                )
+        successes = sum(self.successes.values())
+        if successes > 0:
+            calls = sum(self.decoder_calls.values())
+            print(
+                f"Fallback decoder calls per successful conversion: "
+                f"{calls / successes:.2f}"
+            )
+        if len(self.skipped) > 0:
+            ids = ", ".join(str(a.annotation_id) for a in self.skipped)
+            print(
+                f"Skipped {len(self.skipped)} annotations because the fallback "
+                f"budget was exhausted: {ids}"
+            )
+
 
 def shift_contour(arr: list[float], x_off: float, y_off: float) -> list:
     """Shift the contour on x and y to move the prediction
@@ -267,6 +577,154 @@ def negative_point_sam(
     return contour, contour_area
 
 
+def refine_mask_sam(
+    crop_ann_point: np.ndarray,
+    x_off: float,
+    y_off: float,
+    sam: SamPredictor,
+    expected_area: float,
+    image_area: float,
+    max_iterations: int = 4,
+) -> tuple[list, float] | tuple[None, None]:
+    """
+    Apply the Segment Anything Model and iteratively refine the best mask
+
+    The low-res logits of the smallest mask that exceeds the expected area (see
+    get_refinement_mask_index) are fed back as mask input, together with negative
+    points where the mask exceeds the expected area. The refinement stops as soon as a compatible contour is found
+    or no new negative point can be placed.
+
+    Args:
+        crop_ann_point: Annotation point array
+        x_off: by how much we are off in terms of X coordinates
+        y_off: by how much we are off in terms of Y coordinates
+        sam: Predictor that will execute on the cropped image
+        expected_area: expected area of the new annotation
+        image_area: global image area
+        max_iterations: maximum number of refinement steps after the first prediction
+
+    Returns:
+        tuple containing contour and contour area or of None if unable to find one
+    """
+    point_coords = crop_ann_point
+    point_labels = np.array([1])
+    masks, scores, logits = sam.predict(
+        point_coords=point_coords, point_labels=point_labels, multimask_output=True
+    )
+
+    for iteration in range(max_iterations + 1):
+        contour, contour_area = mask_to_contour(
+            masks, image_area, crop_ann_point, scores, expected_area
+        )
+        if contour is not None and contour_area is not None:
+            return shift_contour(contour, x_off, y_off), contour_area
+
+        if iteration == max_iterations:
+            break
+
+        best = get_refinement_mask_index(
+            masks, scores, crop_ann_point[0], expected_area
+        )
+        negative_points = [
+            p
+            for p in get_excess_points(masks[best], crop_ann_point[0], expected_area)
+            if not (point_coords == p).all(axis=1).any()
+        ]
+        # without new prompts SAM would only reproduce the same mask
+        if len(negative_points) == 0:
+            break
+
+        point_coords = np.concatenate([point_coords, negative_points])
+        point_labels = np.concatenate(
+            [point_labels, np.zeros(len(negative_points), dtype=int)]
+        )
+
+        masks, scores, logits = sam.predict(
+            point_coords=point_coords,
+            point_labels=point_labels,
+            mask_input=logits[best][None, :, :],
+            multimask_output=False,
+        )
+
+    return None, None
+
+
+def get_refinement_mask_index(
+    masks: np.ndarray, scores: np.ndarray, point: np.ndarray, expected_area: float
+) -> int:
+    """
+    Get the mask that should be refined with negative points
+
+    Negative points can only shrink a mask, so the smallest mask that contains the
+    point and exceeds the expected area is preferred. If there is none, the mask
+    whose area is closest to the expected area is used.
+
+    Args:
+        masks: Resulting masks from the SAM prediction
+        scores: Prediction scores from SAM prediction
+        point: coordinates of the point annotation
+        expected_area: expected area of the new annotation
+
+    Returns:
+        index of the mask to refine, the one with the highest score if none contains
+        the point
+    """
+    x = min(max(int(point[0]), 0), masks.shape[2] - 1)
+    y = min(max(int(point[1]), 0), masks.shape[1] - 1)
+    candidates = [idx for idx in range(len(masks)) if masks[idx][y, x]]
+    if len(candidates) == 0:
+        return int(np.argmax(scores))
+
+    areas = np.array([masks[idx].sum() for idx in candidates])
+    too_large = np.nonzero(areas > expected_area * 1.75)[0]
+    if len(too_large) > 0:
+        return candidates[too_large[np.argmin(areas[too_large])]]
+
+    return candidates[int(np.argmin(np.abs(areas - expected_area)))]
+
+
+def get_excess_points(
+    mask: np.ndarray, point: np.ndarray, expected_area: float, sectors: int = 4
+) -> np.ndarray:
+    """
+    Get negative points in the regions where the mask exceeds the expected area
+
+    The expected area is modelled as a disk around the point. The mask outside of
+    this disk is split into angular sectors around the point and a negative point is
+    placed on the pixel of each sector that is farthest from the point, so the
+    negative points mark the leaks instead of the object itself.
+
+    Args:
+        mask: predicted mask
+        point: coordinates of the point annotation
+        expected_area: expected area of the new annotation
+        sectors: number of angular sectors, i.e. maximum number of negative points
+
+    Returns:
+        Array of negative point coordinates, empty if the mask is not too large
+    """
+    if mask.sum() <= expected_area * 1.75:
+        return np.empty((0, 2))
+
+    radius = np.sqrt(expected_area / np.pi) * 1.25
+    ys, xs = np.nonzero(mask)
+    distances = (xs - point[0]) ** 2 + (ys - point[1]) ** 2
+    excess = distances > radius**2
+    xs, ys, distances = xs[excess], ys[excess], distances[excess]
+
+    angles = np.arctan2(ys - point[1], xs - point[0])
+    sector_ids = ((angles + np.pi) / (2 * np.pi) * sectors).astype(int) % sectors
+
+    points = []
+    for sector in range(sectors):
+        in_sector = np.nonzero(sector_ids == sector)[0]
+        if len(in_sector) > 0:
+            idx = in_sector[np.argmax(distances[in_sector])]
+            points.append([xs[idx], ys[idx]])
+
+    return np.array(points, dtype=float).reshape(-1, 2)
+
+
 def zoom_sam(
     ann_point: np.ndarray,
     sam: SamPredictor,
@@ -474,35 +932,135 @@ def transform_mask(
     return None, None
 
 
+def simplify_contour(
+    contour: list,
+    point: tuple[float, float],
+    tolerance: float = 0.0,
+    max_vertices: int = 0,
+) -> list:
+    """
+    Simplify a contour with the Douglas-Peucker algorithm
+
+    If the simplified contour still has more than max_vertices vertices, the
+    tolerance is doubled until it fits. A simplification that no longer contains the
+    point is discarded, so the vertex cap is not met in that case.
+
+    Args:
+        contour: contour of type [x1, y1, x2, y2...]
+        point: coordinates of the point annotation that must stay inside the contour
+        tolerance: maximum distance of the simplified contour to the original
+            contour, relative to its perimeter. 0 to only apply the vertex cap
+        max_vertices: maximum number of vertices, 0 for no limit
+
+    Returns:
+        simplified contour of type [x1, y1, x2, y2...]
+    """
+    original = np.array(contour, dtype=np.int32).reshape(-1, 1, 2)
+    perimeter = cv2.arcLength(original, True)
+    epsilon = tolerance * perimeter
+    simplified = contour
+
+    # 32 doublings are more than enough to reduce any contour to a triangle
+    for _ in range(32):
+        if epsilon > 0:
+            approx = cv2.approxPolyDP(original, epsilon, True)
+            if len(approx) < 3 or not get_point_contour(approx, point):
+                break
+            simplified = approx.flatten().tolist()
+
+        if max_vertices <= 0 or len(simplified) // 2 <= max_vertices:
+            break
+
+        epsilon = epsilon * 2 if epsilon > 0 else max(perimeter * 0.001, 0.5)
+
+    return simplified
+
+
+def simplify_annotations(
+    annotations: list[dict],
+    points: dict,
+    tolerance: float = 0.0,
+    max_vertices: int = 0,
+) -> tuple[int, int]:
+    """
+    Simplify the contours of the converted annotations in place
+
+    Args:
+        annotations: converted annotations
+        points: Mapping of annotation IDs to the coordinates of the point annotation
+        tolerance: see simplify_contour
+        max_vertices: see simplify_contour
+
+    Returns:
+        tuple containing the number of vertices before and after the simplification
+    """
+    before = 0
+    after = 0
+    for annotation in annotations:
+        if not annotation or annotation.get("points") is None:
+            continue
+
+        x, y = points[annotation["annotation_id"]][:2]
+        contour = simplify_contour(
+            annotation["points"], (float(x), float(y)), tolerance, max_vertices
+        )
+        before += len(annotation["points"]) // 2
+        after += len(contour) // 2
+        annotation["points"] = contour
+
+    return before, after
+
+
+def unprocessed_expected_area(annotation: PointAnnotation) -> dict:
+    """
+    Get the result of process_expected_area for an annotation without contour
+
+    Args:
+        annotation: starting PointAnnotation
+
+    Returns:
+        dict in the format of process_expected_area without possible contours
+    """
+    return {
+        "annotation_id": annotation.annotation_id,
+        "label_id": annotation.label,
+        "image_id": annotation.image_id,
+        "possible_contours": None,
+        "contour_area": np.nan,
+        "point_annotation": annotation,
+    }
+
+
 def process_expected_area(
     annotation: PointAnnotation,
     image: np.ndarray,
     sam: SamPredictor,
+    x_off: int = 0,
+    y_off: int = 0,
+    image_area: float | None = None,
 ) -> dict:
     """Process an annotation with the objective to gather its expected area.
 
     Args:
         annotation: starting PointAnnotation
-        image: Image array
+        image: Image array, or the tile of the image that is set in the predictor
         sam: SAM object
+        x_off: x coordinate of the tile in the image
+        y_off: y coordinate of the tile in the image
+        image_area: area of the whole image if image is a tile
 
     Returns:
         dict containing the converted annotation and the expected area
 
     """
     img_height, img_width, _ = image.shape
-    img_area = img_height * img_width
+    img_area = img_height * img_width if image_area is None else image_area
     label_id = annotation.label
-    point_annotation = np.array([[annotation.x, annotation.y]], dtype=float)
+    point_annotation = np.array(
+        [[annotation.x - x_off, annotation.y - y_off]], dtype=float
+    )
     if annotation_is_out_of_bounds(point_annotation[0], img_width, img_height):
-        return {
-            "annotation_id": annotation.annotation_id,
-            "label_id": label_id,
-            "image_id": annotation.image_id,
-            "possible_contours": None,
-            "contour_area": np.nan,
-            "point_annotation": annotation,
-        }
+        return unprocessed_expected_area(annotation)
 
     masks, scores, _ = sam.predict(
         point_coords=point_annotation, point_labels=np.array([1]), multimask_output=True
@@ -521,20 +1079,15 @@ def process_expected_area(
 
         for contour, contour_area in sorted_contours:
             if annotation_is_compatible(contour, contour_area, img_area, 0.05, None):
+                if x_off or y_off:
+                    contour = shift_contour(contour, x_off, y_off)
                 valid_contours.append((contour, contour_area))
 
     except ValueError:
         pass
 
     if len(valid_contours) == 0:
-        return {
-            "annotation_id": annotation.annotation_id,
-            "label_id": label_id,
-            "image_id": annotation.image_id,
-            "possible_contours": None,
-            "contour_area": np.nan,
-            "point_annotation": annotation,
-        }
+        return unprocessed_expected_area(annotation)
 
     return {
         "annotation_id": annotation.annotation_id,
@@ -546,6 +1099,75 @@ def process_expected_area(
     }
 
 
+def get_tile_starts(length: int, tile_size: int, overlap: int) -> list[int]:
+    """
+    Get the start coordinates of overlapping tiles along one image axis
+
+    Args:
+        length: length of the image axis
+        tile_size: length of a tile
+        overlap: minimum overlap of neighbouring tiles
+
+    Returns:
+        List of tile start coordinates, the last tile ends at the image border
+    """
+    if not 0 <= overlap < tile_size:
+        raise ValueError(
+            f"Tile overlap {overlap} must be between 0 and the tile size {tile_size}"
+        )
+    last = max(length - tile_size, 0)
+    starts = list(range(0, last, tile_size - overlap))
+    starts.append(last)
+    return starts
+
+
+def process_expected_area_tiled(
+    annotations: list[PointAnnotation],
+    image: np.ndarray,
+    sam: SamPredictor,
+    tile_size: int = 1024,
+    overlap: int = 256,
+) -> list[dict]:
+    """
+    Run process_expected_area on overlapping encoder-sized tiles of a large image
+
+    Each annotation is assigned to the tile whose center is closest to it. Only
+    tiles that contain at least one annotation are encoded, each of them once.
+
+    Args:
+        annotations: PointAnnotations of the image
+        image: Image array
+        sam: SAM object
+        tile_size: edge length of a tile
+        overlap: minimum overlap of neighbouring tiles
+
+    Returns:
+        list of process_expected_area results, in the order of the annotations
+    """
+    img_height, img_width, _ = image.shape
+    image_area = img_height * img_width
+    x_starts = np.array(get_tile_starts(img_width, tile_size, overlap))
+    y_starts = np.array(get_tile_starts(img_height, tile_size, overlap))
+
+    tiles = defaultdict(list)
+    for idx, annotation in enumerate(annotations):
+        x_off = x_starts[np.argmin(np.abs(x_starts + tile_size / 2 - annotation.x))]
+        y_off = y_starts[np.argmin(np.abs(y_starts + tile_size / 2 - annotation.y))]
+        tiles[(int(x_off), int(y_off))].append(idx)
+
+    results = [None] * len(annotations)
+    for (x_off, y_off), indices in tiles.items():
+        tile = image[y_off : y_off + tile_size, x_off : x_off + tile_size]
+        sam.set_image(tile)
+        for idx in indices:
+            # the area limit must refer to the whole image like in the second pass
+            results[idx] = process_expected_area(
+                annotations[idx], tile, sam, x_off, y_off, image_area
+            )
+
+    return results
+
+
 def process_annotation(
     annotation: PointAnnotation,
     image_id: int,
@@ -566,6 +1188,36 @@ def process_annotation(
     Returns:
         Converted annotation if successful, None otherwise
     """
+    result = process_annotation_zoom(annotation, image_id, image, sam, expected_area)
+    if result is not None:
+        return result
+
+    return process_annotation_fallbacks(
+        annotation, image_id, image, sam, expected_area
+    )
+
+
+def process_annotation_zoom(
+    annotation: PointAnnotation,
+    image_id: int,
+    image: np.ndarray,
+    sam: SamPredictor,
+    expected_area: float,
+) -> dict | None:
+    """
+    Try to convert the point annotation with the cheap zoom stage
+
+    Args:
+        annotation: Point annotation object to convert
+        image_id: ID of the image to which the annotation refers to
+        image: Unsharpened input image
+        sam: SAM predictor object
+        expected_area: expected area for the conversion
+
+    Returns:
+        Converted annotation if successful, empty dict if the annotation cannot be
+        converted at all, None if the fallback strategies should be tried
+    """
     crop_size = 1024
     img_height, img_width, _ = image.shape
     image_area = img_height * img_width
@@ -599,7 +1251,37 @@ def process_annotation(
             "method": "zoom",
         }
 
+    return None
+
+
+def process_annotation_fallbacks(
+    annotation: PointAnnotation,
+    image_id: int,
+    image: np.ndarray,
+    sam: SamPredictor,
+    expected_area: float,
+    methods: list[str] = FALLBACK_METHODS,
+    scheduler: FallbackScheduler | None = None,
+) -> dict:
+    """
+    Try to convert the point annotation with the expensive fallback strategies
+
+    Args:
+        annotation: Point annotation object to convert
+        image_id: ID of the image to which the annotation refers to
+        image: Unsharpened input image
+        sam: SAM predictor object
+        expected_area: expected area for the conversion
+        methods: fallback strategies to try, in order
+        scheduler: if given, records the outcome of each strategy
+
+    Returns:
+        Converted annotation if successful, empty dict otherwise
+    """
     crop_size = 512
+    img_height, img_width, _ = image.shape
+    image_area = img_height * img_width
+    point_annotation = np.array([[annotation.x, annotation.y]], dtype=float)
     if expected_area * 0.25 > crop_size**2 or crop_size**2 > image_area:
         return {}
 
@@ -610,63 +1292,76 @@ def process_annotation(
     crop_ann_point = np.array([[point_annotation[0][0] - x_off, point_annotation[0][1] - y_off]], dtype=float)
     sam.set_image(annotation_crop)
 
-    contour, contour_area = super_zoom_sam(
-        crop_ann_point, sam, expected_area, x_off, y_off, image_area
-    )
-
-    if contour is not None and contour_area is not None:
-        return {
-            "image_id": image_id,
-            "label_id": label_id,
-            "points": contour,
-            "annotation_id": annotation.annotation_id,
-            "contour_area": contour_area,
-            "method": "superzoom",
-        }
-
-    contour, contour_area = negative_point_sam(
-        crop_ann_point[0], x_off, y_off, sam, expected_area, image_area
-    )
-
-    if contour is not None and contour_area is not None:
-        return {
-            "image_id": image_id,
-            "label_id": label_id,
-            "annotation_id": annotation.annotation_id,
-            "contour_area": contour_area,
-            "points": contour,
-            "method": "negative",
-        }
+    for method in methods:
+        decoder_calls = getattr(sam, "decoder_calls", 0)
+        contour, contour_area = run_fallback_method(
+            method, crop_ann_point, x_off, y_off, sam, expected_area, image_area
+        )
+        success = annotation_is_compatible(
+            contour, contour_area, image_area, 0.05, expected_area
+        )
+        if scheduler is not None:
+            decoder_calls = getattr(sam, "decoder_calls", 0) - decoder_calls
+            scheduler.record(method, success, decoder_calls)
+
+        if success:
+            return {
+                "image_id": image_id,
+                "label_id": annotation.label,
+                "annotation_id": annotation.annotation_id,
+                "points": contour,
+                "contour_area": contour_area,
+                "method": method,
+            }
 
-    contour, contour_area = multipoint_sam(
-        crop_ann_point[0], x_off, y_off, sam, expected_area, image_area
-    )
+    return {}
 
-    if contour is not None and contour_area is not None:
-        return {
-            "image_id": image_id,
-            "annotation_id": annotation.annotation_id,
-            "label_id": label_id,
-            "points": contour,
-            "contour_area": contour_area,
-            "method": "multipoint",
-        }
 
-    contour, contour_area = inaccurate_annotation_sam(
-        crop_ann_point[0], x_off, y_off, sam, image_area, expected_area
-    )
+def run_fallback_method(
+    method: str,
+    crop_ann_point: np.ndarray,
+    x_off: float,
+    y_off: float,
+    sam: SamPredictor,
+    expected_area: float,
+    image_area: float,
+) -> tuple[list, float] | tuple[None, None]:
+    """
+    Run a single fallback strategy on the cropped image that is set in the predictor
 
-    if annotation_is_compatible(contour, contour_area, image_area, 0.05, expected_area):
-        return {
-            "image_id": image_id,
-            "label_id": label_id,
-            "annotation_id": annotation.annotation_id,
-            "points": contour,
-            "contour_area": contour_area,
-            "method": "inaccurate",
-        }
+    Args:
+        method: name of the strategy, one of FALLBACK_METHODS or REFINE_METHODS
+        crop_ann_point: Annotation point array in crop coordinates
+        x_off: by how much we are off in terms of X coordinates
+        y_off: by how much we are off in terms of Y coordinates
+        sam: SAM predictor object
+        expected_area: expected area of the new annotation
+        image_area: global image area
 
-    return {}
+    Returns:
+        tuple containing the contour and the area, or tuple of None
+    """
+    if method == "superzoom":
+        return super_zoom_sam(
+            crop_ann_point, sam, expected_area, x_off, y_off, image_area
+        )
+    if method == "negative":
+        return negative_point_sam(
+            crop_ann_point[0], x_off, y_off, sam, expected_area, image_area
+        )
+    if method == "multipoint":
+        return multipoint_sam(
+            crop_ann_point[0], x_off, y_off, sam, expected_area, image_area
+        )
+    if method == "inaccurate":
+        return inaccurate_annotation_sam(
+            crop_ann_point[0], x_off, y_off, sam, image_area, expected_area
+        )
+    if method == "refine":
+        return refine_mask_sam(
+            crop_ann_point, x_off, y_off, sam, expected_area, image_area
+        )
+    raise ValueError(f"Unknown fallback method '{method}'")
 
 
 def crop_annotation(
@@ -706,6 +1401,200 @@ def annotation_is_compatible_with_expected_area(
     )
 
 
+def convert_annotation(
+    result: dict,
+    image: np.ndarray,
+    sam: SamPredictor,
+    expected_area: float,
+    scheduler: FallbackScheduler | None = None,
+) -> dict:
+    """
+    Convert an annotation using the result of the expected area pass
+
+    Args:
+        result: Result of process_expected_area for the annotation
+        image: Image array
+        sam: SAM predictor object
+        expected_area: expected area of the label of the annotation
+        scheduler: if given, records the fallback outcomes and, if it has a budget,
+            receives the annotations that need the fallback strategies
+
+    Returns:
+        Converted annotation if successful, empty dict otherwise
+    """
+    # If a contour was already computed and is valid let's use it
+    if result["possible_contours"] is not None:
+        contours = [
+            (c, area)
+            for c, area in result["possible_contours"]
+            if annotation_is_compatible_with_expected_area(area, expected_area)
+        ]
+        if len(contours) > 0:
+            contour, contour_area = get_best_contour(contours, expected_area)
+            if contour is not None and contour_area is not None:
+                return {
+                    "image_id": result["image_id"],
+                    "label_id": result["label_id"],
+                    "annotation_id": result["annotation_id"],
+                    "points": contour,
+                    "method": "base",
+                    "contour_area": contour_area,
+                }
+
+    annotation = result["point_annotation"]
+    image_id = result["image_id"]
+    converted = process_annotation_zoom(
+        annotation, image_id, image, sam, expected_area
+    )
+    if converted is not None:
+        return converted
+
+    if scheduler is not None and scheduler.has_budget:
+        scheduler.defer(annotation, expected_area)
+        return {}
+
+    methods = scheduler.methods if scheduler is not None else FALLBACK_METHODS
+    return process_annotation_fallbacks(
+        annotation,
+        image_id,
+        image,
+        sam,
+        expected_area,
+        methods=methods,
+        scheduler=scheduler,
+    )
+
+
+def write_csv_output(path: str, annotations: list[dict]) -> None:
+    """
+    Write the converted annotations to a CSV file with the points as JSON lists
+
+    Args:
+        path: path of the output file
+        annotations: converted annotations
+    """
+    import pandas as pd
+
+    resulting_annotations = pd.DataFrame(annotations).dropna(how="all")
+
+    if not resulting_annotations.empty:
+        resulting_annotations.loc[
+            :, ["annotation_id", "points", "image_id", "label_id"]
+        ].to_csv(path, index=False)
+
+
+def write_binary_output(path: str, annotations: list[dict]) -> None:
+    """
+    Write the converted annotations to a binary file with flat coordinate buffers
+
+    All values are little-endian. The file consists of:
+
+    - header: 4 bytes magic "PTPB", uint32 format version, uint64 number of
+      annotations N, uint64 total number of coordinates M
+    - index: N entries of int64 annotation_id, int64 image_id, int64 label_id and
+      uint64 number of coordinates of the polygon (0 if it was not converted)
+    - coordinates: M int32 values x1, y1, x2, y2, ... of all polygons in the order
+      of the index
+
+    Args:
+        path: path of the output file
+        annotations: converted annotations
+    """
+    annotations = [a for a in annotations if a]
+    if len(annotations) == 0:
+        return
+
+    index = np.zeros(
+        len(annotations),
+        dtype=[
+            ("annotation_id", "<i8"),
+            ("image_id", "<i8"),
+            ("label_id", "<i8"),
+            ("count", "<u8"),
+        ],
+    )
+    for idx, annotation in enumerate(annotations):
+        points = annotation.get("points")
+        index[idx] = (
+            annotation["annotation_id"],
+            annotation["image_id"],
+            annotation["label_id"],
+            0 if points is None else len(points),
+        )
+
+    with open(path, "wb") as out:
+        out.write(BINARY_OUTPUT_MAGIC)
+        out.write(np.array([BINARY_OUTPUT_VERSION], dtype="<u4").tobytes())
+        out.write(np.array([len(index), index["count"].sum()], dtype="<u8").tobytes())
+        out.write(index.tobytes())
+        for annotation in annotations:
+            if annotation.get("points") is not None:
+                out.write(np.round(annotation["points"]).astype("<i4").tobytes())
+
+
+def load_checkpoint(model_path: str) -> dict:
+    """
+    Load the state dict of a checkpoint without reading it into memory
+
+    Args:
+        model_path: path to the .pth checkpoint
+
+    Returns:
+        state dict with tensors backed by the memory-mapped file
+    """
+    import torch
+
+    return torch.load(model_path, map_location="cpu", mmap=True, weights_only=True)
+
+
+def load_sam_model(model_type: str, model_path: str, device: str = "cuda"):
+    """
+    Load the SAM model without an intermediate copy of the weights
+
+    The model is created on the meta device and the memory-mapped weights are
+    assigned to it directly. If this fails, the model is loaded the regular way.
+
+    Args:
+        model_type: SAM model type
+        model_path: path to the .pth checkpoint
+        device: device to move the model to
+
+    Returns:
+        SAM model
+    """
+    import inspect
+
+    import torch
+    from segment_anything import sam_model_registry
+    from segment_anything.modeling import Sam
+
+    try:
+        state_dict = load_checkpoint(model_path)
+        with torch.device("meta"):
+            sam_model = sam_model_registry[model_type]()
+        sam_model.load_state_dict(state_dict, assign=True)
+
+        # pixel_mean and pixel_std are non-persistent buffers that are not part of
+        # the checkpoint
+        parameters = inspect.signature(Sam.__init__).parameters
+        for name in ("pixel_mean", "pixel_std"):
+            value = torch.tensor(parameters[name].default, dtype=torch.float32)
+            setattr(sam_model, name, value.view(-1, 1, 1))
+
+        if any(t.is_meta for t in [*sam_model.parameters(), *sam_model.buffers()]):
+            raise RuntimeError("Some weights are missing in the checkpoint")
+    except Exception as e:
+        print(f"Unable to load memory-mapped checkpoint, falling back: {e}")
+        sam_model = sam_model_registry[model_type](checkpoint=model_path)
+
+    return sam_model.to(device)
+
+
+def peak_memory_mb() -> float:
+    """Get the peak resident memory of the process in MB (Linux reports KB)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
 if __name__ == "__main__":
     argparser = argparse.ArgumentParser()
     argparser.add_argument(
@@ -730,7 +1619,89 @@ if __name__ == "__main__":
         help="Where to save the resulting predictions",
         default=".",
     )
+    argparser.add_argument(
+        "--output-format",
+        type=str,
+        choices=["csv", "binary"],
+        help="Format of the output file",
+        default="csv",
+    )
+    argparser.add_argument(
+        "--expected-area-warmup",
+        type=int,
+        help="Number of first pass areas of a label after which its expected area is "
+        "considered stable and annotations are converted while the image is loaded",
+        default=20,
+    )
+    argparser.add_argument(
+        "--fallback-time-budget",
+        type=float,
+        help="Wall-clock seconds to spend on fallback strategies after all cheap "
+        "stages ran",
+        default=None,
+    )
+    argparser.add_argument(
+        "--fallback-encoder-budget",
+        type=int,
+        help="Number of encoder calls to spend on fallback strategies after all "
+        "cheap stages ran",
+        default=None,
+    )
+    argparser.add_argument(
+        "--tile-min-image-size",
+        type=int,
+        help="Images whose long side exceeds this size are split into tiles for the "
+        "expected area pass. Set to 0 to disable tiling",
+        default=4096,
+    )
+    argparser.add_argument(
+        "--tile-size",
+        type=int,
+        help="Edge length of the tiles of the expected area pass",
+        default=1024,
+    )
+    argparser.add_argument(
+        "--tile-overlap",
+        type=int,
+        help="Minimum overlap of neighbouring tiles of the expected area pass",
+        default=256,
+    )
+    argparser.add_argument(
+        "--simplify-tolerance",
+        type=float,
+        help="Douglas-Peucker tolerance relative to the polygon perimeter. Set to 0 "
+        "to disable the simplification",
+        default=0.0,
+    )
+    argparser.add_argument(
+        "--max-vertices",
+        type=int,
+        help="Maximum number of vertices of a polygon. Set to 0 for no limit",
+        default=0,
+    )
+    argparser.add_argument(
+        "--expected-areas-file",
+        type=str,
+        help="JSON file mapping label IDs to prior expected areas. Labels with a "
+        "prior are converted without waiting for the expected area warm-up",
+        default=None,
+    )
+    argparser.add_argument(
+        "--fallback-strategy",
+        type=str,
+        choices=["cascade", "refine"],
+        help="Use the cascade of random prompt fallbacks or refine the previous mask",
+        default="cascade",
+    )
+    argparser.add_argument(
+        "--stats-file",
+        type=str,
+        help="Where to save the statistics of the conversion as JSON",
+        default=None,
+    )
     args = argparser.parse_args()
+    if not 0 <= args.tile_overlap < args.tile_size:
+        argparser.error("--tile-overlap must be at least 0 and less than --tile-size")
     annotations = []
     input_values = {}
     with open(args.input_file, "r") as inp:
@@ -739,11 +1710,30 @@ if __name__ == "__main__":
     with open(args.image_paths_file, "r") as inp:
         image_paths = json.load(inp)
 
-    sam_model = sam_model_registry[args.model_type](checkpoint=args.model_path)
-    sam_model.to("cuda")
-    sam = SamPredictor(sam_model)
+    from segment_anything import SamPredictor
+
+    sam_model = load_sam_model(args.model_type, args.model_path)
+    load_time = time.monotonic() - START_TIME
+    load_peak_memory = peak_memory_mb()
+    print(
+        f"Loaded model after {load_time:.2f} s, peak memory {load_peak_memory:.0f} MB"
+    )
+    sam = CountingPredictor(SamPredictor(sam_model))
 
+    scheduler = FallbackScheduler(
+        args.fallback_time_budget,
+        args.fallback_encoder_budget,
+        REFINE_METHODS if args.fallback_strategy == "refine" else FALLBACK_METHODS,
+    )
+    area_priors = {}
+    if args.expected_areas_file is not None:
+        with open(args.expected_areas_file, "r") as inp:
+            area_priors = {int(k): float(v) for k, v in json.load(inp).items()}
+
+    estimator = ExpectedAreaEstimator(args.expected_area_warmup, area_priors)
     resulting_annotations = []
+    # first pass results of labels whose expected area was not yet stable
+    deferred_annotations = defaultdict(list)
 
     for image_id, annotations in input_values.items():
         if len(annotations) == 0:
@@ -752,92 +1742,119 @@ if __name__ == "__main__":
         if image_path is None:
             raise Exception(f"Missing image path for Image ID {image_id}")
         image = np.array(Image.open(image_path))
-        sam.set_image(image)
+        point_annotations = [
+            PointAnnotation(
+                annotation["points"][0],
+                annotation["points"][1],
+                annotation["label"],
+                annotation["annotation_id"],
+                image_id,
+            )
+            for annotation in annotations
+        ]
+
+        if len(point_annotations) == 1 and estimator.has_prior(
+            point_annotations[0].label
+        ):
+            # The full image embedding would only provide the base contour of a single
+            # annotation, while the zoom stage needs its own crop embedding anyway.
+            # With more annotations the base contours save more encoder calls than
+            # skipping the full image pass.
+            expected_area_results = [
+                unprocessed_expected_area(annotation)
+                for annotation in point_annotations
+            ]
+        elif 0 < args.tile_min_image_size < max(image.shape[:2]):
+            expected_area_results = process_expected_area_tiled(
+                point_annotations, image, sam, args.tile_size, args.tile_overlap
+            )
+        else:
+            sam.set_image(image)
+            expected_area_results = [
+                process_expected_area(annotation, image, sam)
+                for annotation in point_annotations
+            ]
+
+        for result in expected_area_results:
+            estimator.add(result["label_id"], result["contour_area"])
+
+        # process_annotation replaces the full image embedding, so the first pass of
+        # the image must be complete before converting
+        for result in expected_area_results:
+            if not estimator.is_stable(result["label_id"]):
+                deferred_annotations[image_id].append(result)
+                continue
 
-        for annotation in annotations:
             resulting_annotations.append(
-                process_expected_area(
-                    PointAnnotation(
-                        annotation["points"][0],
-                        annotation["points"][1],
-                        annotation["label"],
-                        annotation["annotation_id"],
-                        image_id,
-                    ),
-                    image,
-                    sam,
+                convert_annotation(
+                    result, image, sam, estimator.get(result["label_id"]), scheduler
                 )
             )
 
-    expected_areas = pd.DataFrame(resulting_annotations)
-
-    if expected_areas.empty or expected_areas.dropna(subset=["contour_area"]).empty:
+    if estimator.is_empty():
         raise Exception("Unable to compute the expected area!")
 
-    expected_area_values = (
-        expected_areas
-            .dropna(subset=["contour_area"])
-            .sort_values(
-                "contour_area", ascending=False
-            )
-            .groupby("label_id")
-            .apply(lambda x: x.contour_area.median())
-            .to_dict()
-    )
-
-    resulting_annotations = []
-
-    for image_id in expected_areas.image_id.unique():
-        # here we have already the annotations from base SAM via the expected annotations
-        precomputed_annotations = expected_areas.query("image_id == @image_id")
+    for image_id, expected_area_results in deferred_annotations.items():
         #we checked above that this exists
         image_path = image_paths[image_id]
         image = np.array(Image.open(image_path))
-        for _, row in precomputed_annotations.iterrows():
-            expected_area = expected_area_values.get(row.label_id)
+        for result in expected_area_results:
+            expected_area = estimator.get(result["label_id"])
             if expected_area is None:
                 continue
 
-            # If a contour was already computed and is valid let's use it
-            if (
-                row.possible_contours is not None
-                and len(
-                    (
-                        contours := [
-                            (c, area)
-                            for c, area in row.possible_contours
-                            if annotation_is_compatible_with_expected_area(
-                                area, expected_area
-                            )
-                        ]
-                    )
-                )
-                > 0
-            ):
-                contour, contour_area = get_best_contour(contours, expected_area)
-                if contour is not None and contour_area is not None:
-                    resulting_annotations.append(
-                        {
-                            "image_id": image_id,
-                            "label_id": row.label_id,
-                            "annotation_id": row.annotation_id,
-                            "points": contour,
-                            "method": "base",
-                            "contour_area": contour_area,
-                        }
-                    )
-                    continue
-
             resulting_annotations.append(
-                process_annotation(
-                    row.point_annotation, row.image_id, image, sam, expected_area
-                )
+                convert_annotation(result, image, sam, expected_area, scheduler)
             )
 
-    resulting_annotations = pd.DataFrame(resulting_annotations).dropna(how="all")
+    resulting_annotations.extend(scheduler.run(image_paths, sam))
+    scheduler.report()
+    stats = {"fallback_strategy": args.fallback_strategy, **scheduler.statistics()}
+    stats["startup"] = {
+        "load_time": load_time,
+        "load_peak_memory_mb": load_peak_memory,
+        "time_to_first_prediction": None,
+    }
+    if sam.first_prediction_time is not None:
+        first_prediction = sam.first_prediction_time - START_TIME
+        stats["startup"]["time_to_first_prediction"] = first_prediction
+        print(f"Time to first prediction: {first_prediction:.2f} s")
+    # skipped annotations have no points and are not uploaded
+    resulting_annotations.extend(
+        {
+            "image_id": annotation.image_id,
+            "label_id": annotation.label,
+            "annotation_id": annotation.annotation_id,
+            "points": None,
+            "method": "skipped",
+        }
+        for annotation in scheduler.skipped
+    )
 
-    if not resulting_annotations.empty:
-        os.makedirs(os.path.dirname(args.output_file), exist_ok=True)
-        resulting_annotations.loc[
-            :, ["annotation_id", "points", "image_id", "label_id"]
-        ].to_csv(args.output_file, index=False)
+    if args.simplify_tolerance > 0 or args.max_vertices > 0:
+        before, after = simplify_annotations(
+            resulting_annotations,
+            {
+                annotation["annotation_id"]: annotation["points"]
+                for annotations in input_values.values()
+                for annotation in annotations
+            },
+            args.simplify_tolerance,
+            args.max_vertices,
+        )
+        stats["simplification"] = {"vertices_before": before, "vertices_after": after}
+        if before > 0:
+            print(
+                f"Simplified polygons from {before} to {after} vertices "
+                f"({100 * (1 - after / before):.1f}% smaller)"
+            )
+
+    os.makedirs(os.path.dirname(args.output_file), exist_ok=True)
+    if args.output_format == "binary":
+        write_binary_output(args.output_file, resulting_annotations)
+    else:
+        write_csv_output(args.output_file, resulting_annotations)
+
+    if args.stats_file is not None:
+        with open(args.stats_file, "w") as out:
+            json.dump(stats, out)
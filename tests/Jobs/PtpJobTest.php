@@ -229,6 +229,48 @@ class PtpJobTest extends TestCase
         }
     }
 
+    public function testPtpGenerateAreaPriorsFile(): void
+    {
+        config(['ptp.area_prior_min_samples' => 2]);
+        $job = new MockPtpJob($this->volume, $this->user, $this->uuid);
+        $this->setUpAnnotations();
+
+        // The areas of these polygons are 1 and 3.
+        foreach ([[0, 0, 2, 0, 0, 1], [0, 0, 3, 0, 0, 2]] as $points) {
+            $polygon = ImageAnnotation::factory()->create([
+                'image_id' => $this->image->id,
+                'shape_id' => Shape::polygonId(),
+                'points' => $points,
+            ]);
+            ImageAnnotationLabel::factory()->create([
+                'annotation_id' => $polygon->id,
+                'label_id' => $this->label->id,
+                'user_id' => $this->user->id,
+            ]);
+        }
+
+        // Not enough samples for label2.
+        $polygon = ImageAnnotation::factory()->create([
+            'image_id' => $this->image2->id,
+            'shape_id' => Shape::polygonId(),
+            'points' => [0, 0, 10, 0, 0, 10],
+        ]);
+        ImageAnnotationLabel::factory()->create([
+            'annotation_id' => $polygon->id,
+            'label_id' => $this->label2->id,
+            'user_id' => $this->user->id,
+        ]);
+
+        try {
+            $job->generateAreaPriorsFile();
+            // The label of fakeAnnotation is not attached to a point annotation.
+            $json = json_decode(File::get($this->inputFile.'_area_priors.json'), true);
+            $this->assertEquals([$this->label->id => 2], $json);
+        } finally {
+            File::delete($this->inputFile.'_area_priors.json');
+        }
+    }
+
     public function testPtpPythonFailed(): void
     {
         //Here we test that the real python script is called, fails and the PTP job is cleared
@@ -304,6 +346,7 @@ class PtpJobTest extends TestCase
             $ids = $imageAnnotationValues->pluck('id');
 
             $this->assertEquals(2, count($ids));
+            $this->assertEquals(1, $job->getSkippedAnnotations());
 
             $expectedValue = [[
                 'id' => $ids[0],
@@ -372,6 +415,71 @@ class PtpJobTest extends TestCase
         }
     }
 
+    public function testPtpUploadedAnnotationsBinary(): void
+    {
+        //Test that annotations of the binary output format are correctly uploaded
+        config(['ptp.output_format' => 'binary']);
+        $job = new MockPtpJob($this->volume, $this->user2, $this->uuid);
+        $this->setUpAnnotations();
+        $outputFile = config('ptp.temp_dir').'/ptp/'.$this->volume->id.'_converted_annotations.bin';
+        try {
+            $rows = [
+                [1, $this->image->id, $this->label->id, [1, 2, 3, 4, 5, 6]],
+                [2, $this->image2->id, $this->label2->id, [7, 8, 9, 10, -1, 12]],
+                //This annotation should not be uploaded
+                [3, $this->image2->id, $this->label2->id, []],
+            ];
+
+            $index = '';
+            $coordinates = '';
+            foreach ($rows as [$annotationId, $imageId, $labelId, $points]) {
+                $index .= pack('PPPP', $annotationId, $imageId, $labelId, count($points));
+                $coordinates .= pack('V*', ...$points);
+            }
+            $header = pack('a4VPP', 'PTPB', 1, count($rows), strlen($coordinates) / 4);
+            File::put($outputFile, $header.$index.$coordinates);
+
+            $job->uploadConvertedAnnotations();
+
+            $imageAnnotationValues = ImageAnnotation::whereIn('image_id', [$this->image->id, $this->image2->id])
+                ->whereNotIn('id', [$this->imageAnnotation->id, $this->imageAnnotation2->id, $this->fakeAnnotation->id])
+                ->orderBy('id')
+                ->select('points', 'image_id', 'shape_id')
+                ->get()
+                ->toArray();
+
+            $expectedValue = [[
+                'points' => [1, 2, 3, 4, 5, 6],
+                'image_id' => $this->image->id,
+                'shape_id' => Shape::polygonId(),
+            ], [
+                'points' => [7, 8, 9, 10, -1, 12],
+                'image_id' => $this->image2->id,
+                'shape_id' => Shape::polygonId(),
+            ]];
+
+            $this->assertEquals($expectedValue, $imageAnnotationValues);
+        } finally {
+            File::delete($outputFile);
+        }
+    }
+
+    public function testPtpUploadedAnnotationsMalformedBinary(): void
+    {
+        config(['ptp.output_format' => 'binary']);
+        $job = new MockPtpJob($this->volume, $this->user2, $this->uuid);
+        $outputFile = config('ptp.temp_dir').'/ptp/'.$this->volume->id.'_converted_annotations.bin';
+        File::put($outputFile, 'annotation_id,points,image_id,label_id');
+
+        $this->expectException(Exception::class);
+        $this->expectExceptionMessage('is malformed');
+        try {
+            $job->uploadConvertedAnnotations();
+        } finally {
+            File::delete($outputFile);
+        }
+    }
+
     public function testPtpSuccessfulHandle(): void
     {
         //Test that the PTP job handle is executed correctly from start to finish.
@@ -482,6 +590,11 @@ class MockPtpJob extends PtpJob
         parent::__construct(...$args);
     }
 
+    public function getSkippedAnnotations(): int
+    {
+        return $this->skippedAnnotations;
+    }
+
     protected function python(): void
     {
         $this->pythonCalled += 1;